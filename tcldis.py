@@ -1,8 +1,9 @@
 from __future__ import print_function
 
 import struct
-import itertools
-from collections import namedtuple, OrderedDict
+import multiprocessing
+from array import array
+from collections import Counter, OrderedDict
 
 import _tcldis
 printbc = _tcldis.printbc
@@ -24,9 +25,10 @@ getbc.__doc__ = _tcldis.getbc.__doc__
 literal_convert = _tcldis.literal_convert
 
 INSTRUCTIONS = _tcldis.inst_table()
-JUMP_INSTRUCTIONS = [
+JUMP_INSTRUCTIONS = frozenset([
     'jump1', 'jump4', 'jumpTrue1', 'jumpTrue4', 'jumpFalse1', 'jumpFalse4'
-]
+])
+PUSH_INSTRUCTIONS = frozenset(['push1', 'push4'])
 
 TAG_BLOCK_JOIN = 'block_join'
 TAG_BLOCK_RM   = 'block_rm'
@@ -37,38 +39,118 @@ TAG_I_PUSH     = 'i_push'
 TAG_I_OTHER    = 'i_other'
 TAG_H_VARIABLE = 'h_variable'
 
-def _getop(optype):
-    """
-    Given a C struct descriptor, return a function which will take the necessary
-    bytes off the front of a bytearray and return the python value.
-    """
-    def getop_lambda(bc):
-        # The 'standard' sizes in the struct module match up to what Tcl expects
-        numbytes = struct.calcsize(optype)
-        opbytes = ''.join([chr(bc.pop(0)) for _ in range(numbytes)])
-        return struct.unpack(optype, opbytes)[0]
-    return getop_lambda
+# The 'standard' sizes in the struct module match up to what Tcl expects.
+# Single bytes are quicker to index directly than to unpack.
+_unpack_int4 = struct.Struct('>i').unpack_from
+_unpack_uint4 = struct.Struct('>I').unpack_from
+
+def _getaux(bc, n):
+    auxtype, auxdata = bc.aux(n)
+    if auxtype == 'ForeachInfo':
+        auxdata = [
+            [bc.local(varidx) for varidx in varlist]
+            for varlist in auxdata
+        ]
+    else:
+        assert False
+    return (auxtype, auxdata)
 
 # InstOperandType from tclCompile.h
+# Each entry is the operand type name, its width in bytes and a python
+# expression reading the value at offset %(o)s of the bytearray 'bytecode'
+# (for the BC 'bc'), or None if decoding the operand should fail.
 OPERANDS = [
-    ('NONE',  None), # Should never be present
-    ('INT1',  _getop('>b')),
-    ('INT4',  _getop('>i')),
-    ('UINT1', _getop('>B')),
-    ('UINT4', _getop('>I')),
-    ('IDX4',  _getop('>i')),
-    ('LVT1',  _getop('>B')),
-    ('LVT4',  _getop('>I')),
-    ('AUX4',  _getop('>I')),
+    ('NONE',  0, None), # Should never be present
+    ('INT1',  1, '(bytecode[%(o)s] ^ 0x80) - 0x80'),
+    ('INT4',  4, '_unpack_int4(bytecode, %(o)s)[0]'),
+    ('UINT1', 1, 'bytecode[%(o)s]'),
+    ('UINT4', 4, '_unpack_uint4(bytecode, %(o)s)[0]'),
+    ('IDX4',  4, None), # Not understood by the reductions yet
+    ('LVT1',  1, 'bc.local(bytecode[%(o)s])'),
+    ('LVT4',  4, 'bc.local(_unpack_uint4(bytecode, %(o)s)[0])'),
+    ('AUX4',  4, '_getaux(bc, _unpack_uint4(bytecode, %(o)s)[0])'),
 ]
 
+def _decodeops_unknown(bc, bytecode, loc):
+    assert False
+
+def _inst_decodeops(opnums):
+    """
+    Generate a function specialised to read the given operand types of an
+    instruction. It takes (bc, bytecode, loc) and returns a tuple of the
+    operand values, with every read inlined rather than looping over the
+    operand types.
+    """
+    exprs = []
+    offset = 1
+    for opnum in opnums:
+        if opnum >= len(OPERANDS) or OPERANDS[opnum][2] is None:
+            # Only fail if an instruction like this is actually decoded
+            return _decodeops_unknown
+        _, opsize, expr = OPERANDS[opnum]
+        exprs.append(expr % {'o': 'loc+%s' % (offset,)})
+        offset += opsize
+    src = 'def decodeops(bc, bytecode, loc):\n    return (%s)\n' % (
+        ''.join([expr + ', ' for expr in exprs]),
+    )
+    namespace = {
+        '_unpack_int4': _unpack_int4,
+        '_unpack_uint4': _unpack_uint4,
+        '_getaux': _getaux,
+    }
+    exec(src, namespace)
+    return namespace['decodeops']
+
+def _inst_decode():
+    """
+    Flatten the instruction and operand tables into a list indexed by opcode,
+    so decoding an instruction needs no dict lookups. Each entry is
+    (name, num_bytes, decodeops, is_jump), see _inst_decodeops.
+    """
+    inst_decode = []
+    # Instructions with the same operand types share a decodeops function
+    decodeops_cache = {}
+    for inst_type in INSTRUCTIONS:
+        opnums = tuple(inst_type['operands'])
+        if opnums not in decodeops_cache:
+            decodeops_cache[opnums] = _inst_decodeops(opnums)
+        inst_decode.append((
+            # Interned so comparisons with the names written in this module
+            # (also interned) succeed on identity without comparing characters
+            intern(inst_type['name']),
+            inst_type['num_bytes'],
+            decodeops_cache[opnums],
+            inst_type['name'] in JUMP_INSTRUCTIONS,
+        ))
+    return inst_decode
+
+INST_DECODE = _inst_decode()
+
+def _opcode_flags(names):
+    """
+    Return a list indexed by opcode which is True for the named instructions.
+    """
+    return [inst_type['name'] in names for inst_type in INSTRUCTIONS]
+
+# Instructions which always start a new basic block
+IS_CATCH_OPCODE = _opcode_flags(['beginCatch4', 'endCatch'])
+IS_PUSH_OPCODE = _opcode_flags(PUSH_INSTRUCTIONS)
+# The num_bytes of each INST_DECODE entry (always small) as a bytearray,
+# which getinsts indexes faster than the tuples
+INST_NUM_BYTES = bytearray([inst_decode[1] for inst_decode in INST_DECODE])
+
 class BC(object):
     def __init__(self, bytecode, bcliterals, bclocals, bcauxs):
+        # Decoding indexes the bytecode directly and expects ints back, so
+        # normalise anything else (e.g. a str or a list of ints) once here.
+        if type(bytecode) is not bytearray:
+            bytecode = bytearray(bytecode)
         self._bytecode = bytecode
         self._literals = bcliterals
         self._locals = bclocals
         self._auxs = bcauxs
         self._pc = 0
+        self._bcliterals = None
     def __repr__(self):
         return 'BC(%s,%s,%s,%s,%s)' % tuple([repr(v) for v in [
             self._bytecode,
@@ -93,10 +175,20 @@ class BC(object):
         return len(self._bytecode) - self._pc
     def literal(self, n):
         return self._literals[n]
+    def bcliteral(self, n):
+        """
+        Return literal n as a BCLiteral. These are created once per BC and
+        shared by every push of the literal.
+        """
+        if self._bcliterals is None:
+            self._bcliterals = [BCLiteral(None, lit) for lit in self._literals]
+        return self._bcliterals[n]
     def local(self, n):
         return self._locals[n]
     def aux(self, n):
         return self._auxs[n]
+    def bytecode(self):
+        return self._bytecode
     def peek1(self):
         return self._bytecode[self._pc]
     def pc(self):
@@ -105,52 +197,49 @@ class BC(object):
         oldpc = self._pc
         self._pc += n
         return self._bytecode[oldpc:self._pc]
+    def key(self):
+        """
+        Return a hashable value which is equal for BC objects with the same
+        bytecode, literals, locals, auxs and pc.
+        """
+        return (
+            bytes(self._bytecode),
+            tuple(self._literals),
+            tuple(self._locals),
+            repr(self._auxs),
+            self._pc,
+        )
     def copy(self):
         bc = BC(self._bytecode, self._literals, self._locals, self._auxs)
-        bc.get(self._pc)
+        # Not get(), which would copy out the bytes being skipped
+        bc._pc = self._pc
         return bc
 
+# Flags for the kind class attribute of anything that can be in a bblock,
+# these are cheaper to test than isinstance when reducing
+KIND_INST = 1
+KIND_VALUE = 2
+KIND_NONVALUE = 4
+KIND_SIMPLE = 8 # A literal or variable reference, cheap to duplicate
+
 # Tcl bytecode instruction
-InstTuple = namedtuple('InstTuple', ['loc', 'name', 'ops', 'targetloc'])
-class Inst(InstTuple):
-    def __new__(cls, bc):
-        d = {}
-        d['loc'] = bc.pc()
-        bytecode = bc.get(INSTRUCTIONS[bc.peek1()]['num_bytes'])
-        inst_type = INSTRUCTIONS[bytecode.pop(0)]
-        d['name'] = inst_type['name']
-        ops = []
-        for opnum in inst_type['operands']:
-            optype, getop = OPERANDS[opnum]
-            if optype in ['INT1', 'INT4', 'UINT1', 'UINT4']:
-                ops.append(getop(bytecode))
-            elif optype in ['LVT1', 'LVT4']:
-                ops.append(bc.local(getop(bytecode)))
-            elif optype in ['AUX4']:
-                ops.append(bc.aux(getop(bytecode)))
-                auxtype, auxdata = ops[-1]
-                if auxtype == 'ForeachInfo':
-                    auxdata = [
-                        [bc.local(varidx) for varidx in varlist]
-                        for varlist in auxdata
-                    ]
-                else:
-                    assert False
-                ops[-1] = (auxtype, auxdata)
-            else:
-                assert False
-        d['ops'] = tuple(ops)
+class Inst(object):
+    __slots__ = ('loc', 'opcode', 'name', 'ops', 'targetloc')
+    kind = KIND_INST
+    def __init__(self, bc, loc):
+        self.loc = loc
+        # Operands are read in place, the bytecode is never copied or consumed
+        bytecode = bc.bytecode()
+        self.opcode = bytecode[loc]
+        name, _, decodeops, is_jump = INST_DECODE[self.opcode]
+        self.name = name
+        self.ops = decodeops(bc, bytecode, loc)
 
         # Note that this doesn't get printed on str() so we only see
         # the value when it gets reduced to a BCJump class
-        d['targetloc'] = None
-        if d['name'] in JUMP_INSTRUCTIONS:
-            d['targetloc'] = d['loc'] + d['ops'][0]
-
-        return super(Inst, cls).__new__(cls, **d)
-
-    def __init__(self, bc, *args, **kwargs):
-        super(Inst, self).__init__(*args, **kwargs)
+        self.targetloc = None
+        if is_jump:
+            self.targetloc = loc + self.ops[0]
 
     def __str__(self):
         return '<%s: %s %s>' % (
@@ -165,11 +254,11 @@ class Inst(InstTuple):
 
 # The below represent my interpretation of the Tcl stack machine
 
-BCValueTuple = namedtuple('BCValueTuple', ['inst', 'value', 'stackn'])
-class BCValue(BCValueTuple):
-    def __new__(cls, inst, value):
-        d = {}
-        d['inst'] = inst
+class BCValue(object):
+    __slots__ = ('inst', 'value', 'stackn', '_fmt')
+    kind = KIND_VALUE
+    def __init__(self, inst, value):
+        self.inst = inst
         if type(value) is list:
             assert all([v.stackn == 1 for v in value if isinstance(v, BCValue)])
             value = tuple(value)
@@ -177,27 +266,54 @@ class BCValue(BCValueTuple):
             pass
         else:
             assert False
-        d['value'] = value
-        d['stackn'] = 1
-        return super(BCValue, cls).__new__(cls, **d)
-    def __init__(self, inst, value, *args, **kwargs):
-        super(BCValue, self).__init__(*args, **kwargs)
+        self.value = value
+        self.stackn = 1
+        self._fmt = None
     def destack(self):
         assert self.stackn == 1
-        return self._replace(stackn=self.stackn-1)
+        # Values may be shared (e.g. literals), so never modify in place.
+        # This copies without rerunning the checks in __init__.
+        value = object.__new__(type(self))
+        value.inst = self.inst
+        value.value = self.value
+        value.stackn = self.stackn - 1
+        value._fmt = None
+        return value
     def __repr__(self): assert False
-    def fmt(self): assert False
+    def fmt(self):
+        """
+        Values are never modified and are formatted again for every step of
+        decompile_steps, so subclasses implement _build_fmt and the result is
+        cached here.
+        """
+        if self._fmt is None:
+            self._fmt = self._build_fmt()
+        return self._fmt
+    def _build_fmt(self): assert False
+
+# Characters which stop a literal being formatted as is, and those which
+# can only be written escaped
+_LITERAL_SPECIAL = frozenset('$[]{}"\f\r\n\t\v ')
+_LITERAL_ESCAPED = frozenset('\f\r\v')
+# For unicode.translate, escaping everything in a single pass
+_LITERAL_ESCAPE = dict([(ord(c), u'\\' + e) for c, e in [
+    ('\\', '\\'), ('\f', 'f'), ('\r', 'r'), ('\n', 'n'), ('\t', 't'),
+    ('\v', 'v'), ('}', '}'), ('{', '{'), ('"', '"'), ('[', '['), (']', ']'),
+    ('$', '$'),
+]])
 
 class BCLiteral(BCValue):
-    def __init__(self, *args, **kwargs):
-        super(BCLiteral, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    kind = KIND_VALUE | KIND_SIMPLE
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         assert type(self.value) is unicode
     def __repr__(self):
         return 'BCLiteral(%s)' % (repr(self.value),)
-    def fmt(self):
+    def _build_fmt(self):
         val = self.value
         if val == '': return u'{}'
-        if not any([c in val for c in '$[]{}""\f\r\n\t\v ']):
+        if _LITERAL_SPECIAL.isdisjoint(val):
             return val
 
         # Can't use simple case, go the hard route
@@ -213,78 +329,70 @@ class BCLiteral(BCValue):
         # Note we don't try and match \n or \t - these are probably used
         # in multiline strings, so if possible use {} quoting and print
         # them literally.
-        if any([c in val for c in '\f\r\v']) or not matching_brackets:
-            val = (val
-                .replace('\\', '\\\\')
-                .replace('\f', '\\f')
-                .replace('\r', '\\r')
-                .replace('\n', '\\n')
-                .replace('\t', '\\t')
-                .replace('\v', '\\v')
-                .replace('}', '\\}')
-                .replace('{', '\\{')
-                .replace('"', '\\"')
-                .replace('"', '\\"')
-                .replace('[', '\\[')
-                .replace(']', '\\]')
-                .replace('$', '\\$')
-            )
-            val = u'"%s"' % (val,)
+        if not _LITERAL_ESCAPED.isdisjoint(val) or not matching_brackets:
+            val = u'"%s"' % (val.translate(_LITERAL_ESCAPE),)
         else:
             val = u'{%s}' % (val,)
         return val
 
 class BCVarRef(BCValue):
-    def __init__(self, *args, **kwargs):
-        super(BCVarRef, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    kind = KIND_VALUE | KIND_SIMPLE
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         assert len(self.value) == 1
     def __repr__(self):
         return 'BCVarRef(%s)' % (repr(self.value),)
-    def fmt(self):
+    def _build_fmt(self):
         return u'$' + self.value[0].fmt()
 
 class BCArrayRef(BCValue):
-    def __init__(self, *args, **kwargs):
-        super(BCArrayRef, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    kind = KIND_VALUE | KIND_SIMPLE
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         assert len(self.value) == 2
     def __repr__(self):
         return 'BCArrayRef(%s)' % (repr(self.value),)
-    def fmt(self):
+    def _build_fmt(self):
         return u'$%s(%s)' % (self.value[0].fmt(), self.value[1].fmt())
 
 class BCConcat(BCValue):
-    def __init__(self, *args, **kwargs):
-        super(BCConcat, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         assert len(self.value) > 1
     def __repr__(self):
         return 'BCConcat(%s)' % (repr(self.value),)
-    def fmt(self):
+    def _build_fmt(self):
         # TODO: this won't always work, need to be careful of
         # literals following variables
         return u'"%s"' % (u''.join([v.fmt() for v in self.value]),)
 
 class BCProcCall(BCValue):
-    def __init__(self, *args, **kwargs):
-        super(BCProcCall, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         assert len(self.value) >= 1
     def __repr__(self):
         return 'BCProcCall(%s)' % (self.value,)
-    def fmt(self):
-        args = list(self.value)
-        if args[0].fmt() == u'::tcl::array::set':
-            args[0:1] = [BCLiteral(None, 'array'), BCLiteral(None, 'set')]
-        cmd = u' '.join([arg.fmt() for arg in args])
+    def _build_fmt(self):
+        args = [arg.fmt() for arg in self.value]
+        if args[0] == u'::tcl::array::set':
+            args[0] = u'array set'
+        cmd = u' '.join(args)
         if self.stackn:
             cmd = u'[%s]' % (cmd,)
         return cmd
 
 class BCSet(BCProcCall):
-    def __init__(self, *args, **kwargs):
-        super(BCSet, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         assert len(self.value) == 2
     def __repr__(self):
         return 'BCSet(%s)' % (self.value,)
-    def fmt(self):
+    def _build_fmt(self):
         cmd = u'set %s %s' % tuple([v.fmt() for v in self.value])
         if self.stackn:
             cmd = u'[%s]' % (cmd,)
@@ -297,20 +405,22 @@ class BCSet(BCProcCall):
 # Additionally, note there is a hack we apply before reducing to recognise
 # that Tcl gives variable calls a return value.
 class BCVariable(BCProcCall):
-    def __init__(self, *args, **kwargs):
-        super(BCVariable, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         assert len(self.value) == 1
         # self.value[0].fmt() is the fully qualified name, if appropriate
         assert self.value[0].fmt().endswith(self.inst.ops[0])
     def __repr__(self):
         return 'BCVariable(%s)' % (self.value,)
-    def fmt(self):
+    def _build_fmt(self):
         cmd = u'variable %s' % (self.value[0].fmt(),)
         if self.stackn:
             cmd = u'[%s]' % (cmd,)
         return cmd
 
 class BCExpr(BCValue):
+    __slots__ = ()
     _exprmap = {
         'gt': (u'>', 2),
         'lt': (u'<', 2),
@@ -321,8 +431,8 @@ class BCExpr(BCValue):
         'add': (u'+', 2),
         'not': (u'!', 1),
     }
-    def __init__(self, *args, **kwargs):
-        super(BCExpr, self).__init__(*args, **kwargs)
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         _, nargs = self._exprmap[self.inst.name]
         assert len(self.value) == nargs
     def __repr__(self):
@@ -334,19 +444,20 @@ class BCExpr(BCValue):
         elif nargs == 2:
             expr = u'%s %s %s' % (self.value[0].fmt(), op, self.value[1].fmt())
         return expr
-    def fmt(self):
+    def _build_fmt(self):
         return u'[expr {%s}]' % (self.expr(),)
 
 class BCReturn(BCProcCall):
-    def __init__(self, *args, **kwargs):
-        super(BCReturn, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         assert len(self.value) == 2
         assert self.value[1].value == '' # Options
         assert self.inst.ops[0] == 0 # Code
         assert self.inst.ops[1] == 1 # Level
     def __repr__(self):
         return 'BCReturn(%s)' % (repr(self.value),)
-    def fmt(self):
+    def _build_fmt(self):
         if self.value[0].value == '': return u'return'
         return u'return %s' % (self.value[0].fmt(),)
 
@@ -356,15 +467,16 @@ class BCReturn(BCProcCall):
 # the stack (after consuming two items). The overall stack effect is the same,
 # but the end value is different...
 class BCDone(BCProcCall):
-    def __init__(self, *args, **kwargs):
-        super(BCDone, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         # Unfortunately cannot be sure this is a BCProcCall as done is sometimes
         # used for the return call (i.e. tcl throws away the information that we've
         # written 'return'.
         assert len(self.value) == 1
     def __repr__(self):
         return 'BCDone(%s)' % (repr(self.value),)
-    def fmt(self):
+    def _build_fmt(self):
         # In the general case it's impossible to guess whether 'return' was written.
         if isinstance(self.value[0], BCProcCall):
             return self.value[0].destack().fmt()
@@ -372,14 +484,15 @@ class BCDone(BCProcCall):
 
 # self.value contains two bblocks, self.inst contains two jumps
 class BCIf(BCProcCall):
-    def __init__(self, *args, **kwargs):
-        super(BCIf, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         assert len(self.value) == len(self.inst) == 2
         assert all([isinstance(jump, BCJump) for jump in self.inst])
         assert self.inst[0].on in (True, False) and self.inst[1].on is None
     def __repr__(self):
         return 'BCIf(%s)' % (self.value,)
-    def fmt(self):
+    def _build_fmt(self):
         value = list(self.value)
         # An if condition takes 'ownership' of the values returned in any
         # of its branches
@@ -401,47 +514,49 @@ class BCIf(BCProcCall):
             conditionstr = self.inst[0].value[0].fmt()
             if self.inst[0].on is True:
                 conditionstr = '!%s' % (conditionstr,)
-        cmd = (
-            u'if {%s} {\n\t%s\n}' % (conditionstr, value[0].fmt().replace('\n', '\n\t'))
-        )
         if len(value[1].insts) > 0:
-            cmd += (
-                u' else {\n\t%s\n}' % (value[1].fmt().replace('\n', '\n\t'),)
+            cmd = u'if {%s} {\n\t%s\n} else {\n\t%s\n}' % (
+                conditionstr, value[0].fmt_indented(), value[1].fmt_indented(),
             )
+        else:
+            cmd = u'if {%s} {\n\t%s\n}' % (conditionstr, value[0].fmt_indented())
         if self.stackn:
             cmd = u'[%s]' % (cmd,)
         return cmd
 
 class BCCatch(BCProcCall):
-    def __init__(self, *args, **kwargs):
-        super(BCCatch, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         assert len(self.value) == 3
         assert all([isinstance(v, BBlock) for v in self.value])
-        begin, middle, end = self.value
+        begininsts, middleinsts, endinsts = [v.insts for v in self.value]
         # Make sure we recognise the overall structure of this catch
         assert (all([
-            len(begin.insts) >= 4, # beginCatch4, code, return code, jump
-            len(middle.insts) == 2,
-            len(end.insts) == 4,
+            len(begininsts) >= 4, # beginCatch4, code, return code, jump
+            len(middleinsts) == 2,
+            len(endinsts) == 4,
         ]) and all([
-            isinstance(begin.insts[-3], BCProcCall),
-            isinstance(begin.insts[-2], BCLiteral),
-            isinstance(begin.insts[-1], BCJump),
+            isinstance(begininsts[-3], BCProcCall),
+            isinstance(begininsts[-2], BCLiteral),
+            isinstance(begininsts[-1], BCJump),
         ]) and all([
-            middle.insts[0].name == 'pushResult',
-            middle.insts[1].name == 'pushReturnCode',
-            end.insts[0].name    == 'endCatch',
-            end.insts[1].name    == 'reverse', end.insts[1].ops[0] == 2,
-            end.insts[2].name    == 'storeScalar1',
-            end.insts[3].name    == 'pop',
+            middleinsts[0].name == 'pushResult',
+            middleinsts[1].name == 'pushReturnCode',
+            endinsts[0].name    == 'endCatch',
+            endinsts[1].name    == 'reverse', endinsts[1].ops[0] == 2,
+            endinsts[2].name    == 'storeScalar1',
+            endinsts[3].name    == 'pop',
         ]))
     def __repr__(self):
         return 'BCCatch(%s)' % (self.value,)
-    def fmt(self):
+    def _build_fmt(self):
         begin, _, end = self.value
         # Nail down the details and move things around to our liking
-        begin = begin.replaceinst((-3, -2), [begin.insts[-3].destack()])
-        begin = begin.popinst().popinst().replaceinst(0, [])
+        n = len(begin.insts)
+        begin = begin.replaceinsts([
+            (0, 1, []), (n-3, n, [begin.insts[-3].destack()])
+        ])
         catchblock = begin.fmt()
         varname = end.insts[2].ops[0]
         cmd = u'catch {%s} %s' % (catchblock, varname)
@@ -450,41 +565,45 @@ class BCCatch(BCProcCall):
         return cmd
 
 class BCForeach(BCProcCall):
-    def __init__(self, *args, **kwargs):
-        super(BCForeach, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    def __init__(self, inst, value):
+        BCValue.__init__(self, inst, value)
         assert len(self.value) == 4
         assert all([isinstance(v, BBlock) for v in self.value[:3]])
         begin, step, code, lit = self.value
+        begininsts, stepinsts, codeinsts = begin.insts, step.insts, code.insts
         # Make sure we recognise the overall structure of foreach
         assert (all([
-            len(begin.insts) == 2, # list temp var, foreach start
-            len(step.insts) == 2, # foreach step, jumpfalse
-            len(code.insts) > 1,
+            len(begininsts) == 2, # list temp var, foreach start
+            len(stepinsts) == 2, # foreach step, jumpfalse
+            len(codeinsts) > 1,
         ]) and all([
-            isinstance(begin.insts[0], BCSet),
-            isinstance(begin.insts[1], Inst),
-            isinstance(step.insts[0], Inst),
-            isinstance(step.insts[1], Inst),
-            isinstance(code.insts[-1], BCJump),
+            isinstance(begininsts[0], BCSet),
+            isinstance(begininsts[1], Inst),
+            isinstance(stepinsts[0], Inst),
+            isinstance(stepinsts[1], Inst),
+            isinstance(codeinsts[-1], BCJump),
             isinstance(lit, BCLiteral),
         ]) and all([
-            begin.insts[1].name == 'foreach_start4',
-            step.insts[0].name == 'foreach_step4',
-            step.insts[1].name == 'jumpFalse1',
+            begininsts[1].name == 'foreach_start4',
+            stepinsts[0].name == 'foreach_step4',
+            stepinsts[1].name == 'jumpFalse1',
         ]))
         # Nail down the details and move things around to our liking
-        assert begin.insts[1].ops[0] == step.insts[0].ops[0]
-        assert len(begin.insts[1].ops[0][1]) == 1
+        foreach_start_ops = begininsts[1].ops
+        assert foreach_start_ops[0] == stepinsts[0].ops[0]
+        assert len(foreach_start_ops[0][1]) == 1
     def __repr__(self):
         return 'BCForeach(%s)' % (self.value,)
-    def fmt(self):
+    def _build_fmt(self):
         value = list(self.value)
         value[2] = value[2].popinst()
         # TODO: this is lazy
         fevars = ' '.join(value[0].insts[1].ops[0][1][0])
         felist = value[0].insts[0].value[1].fmt()
-        feblock = '\n\t' + value[2].fmt().replace('\n', '\n\t') + '\n'
-        cmd = u'foreach {%s} %s {%s}' % (fevars, felist, feblock)
+        cmd = u'foreach {%s} %s {\n\t%s\n}' % (
+            fevars, felist, value[2].fmt_indented(),
+        )
         if self.stackn:
             cmd = u'[%s]' % (cmd,)
         return cmd
@@ -494,16 +613,18 @@ class BCForeach(BCProcCall):
 ####################################################################
 
 class BCNonValue(object):
-    def __init__(self, inst, value, *args, **kwargs):
-        super(BCNonValue, self).__init__(*args, **kwargs)
+    __slots__ = ('inst', 'value')
+    kind = KIND_NONVALUE
+    def __init__(self, inst, value):
         self.inst = inst
         self.value = value
     def __repr__(self): assert False
     def fmt(self): assert False
 
 class BCJump(BCNonValue):
-    def __init__(self, on, *args, **kwargs):
-        super(BCJump, self).__init__(*args, **kwargs)
+    __slots__ = ('on', 'targetloc')
+    def __init__(self, on, inst, value):
+        BCNonValue.__init__(self, inst, value)
         assert len(self.value) == 0 if on is None else 1
         self.on = on
         self.targetloc = self.inst.targetloc
@@ -518,8 +639,9 @@ class BCJump(BCNonValue):
 
 # Just a formatting container for the form a(x)
 class BCArrayElt(BCNonValue):
-    def __init__(self, *args, **kwargs):
-        super(BCArrayElt, self).__init__(*args, **kwargs)
+    __slots__ = ()
+    def __init__(self, inst, value):
+        BCNonValue.__init__(self, inst, value)
         assert len(self.value) == 2
     def __repr__(self):
         return 'BCArrayElt(%s)' % (repr(self.value),)
@@ -532,12 +654,33 @@ class BCArrayElt(BCNonValue):
 
 # Basic block, containing a linear flow of logic
 class BBlock(object):
-    def __init__(self, insts, loc, *args, **kwargs):
-        super(BBlock, self).__init__(*args, **kwargs)
+    __slots__ = (
+        'insts', 'loc', 'catch', 'jump', 'reduced', '_num_unreduced',
+        '_targets', '_fmt_insts'
+    )
+    def __init__(self, insts, loc):
         assert type(insts) is list
         assert type(loc) is int
         self.insts = tuple(insts)
         self.loc = loc
+        # 'beginCatch4' or 'endCatch' if this begins with that instruction,
+        # these are checked for every bblock by _bblock_join and _bblock_flow
+        self.catch = None
+        if insts:
+            first = insts[0]
+            if first.kind == KIND_INST and IS_CATCH_OPCODE[first.opcode]:
+                self.catch = first.name
+        # The BCJump this ends with, if any
+        self.jump = None
+        if insts and type(insts[-1]) is BCJump:
+            self.jump = insts[-1]
+        # Set once _bblock_reduce finds nothing to reduce
+        self.reduced = False
+        self._num_unreduced = None
+        self._targets = None
+        # BBlocks are never modified and most are unchanged between steps of
+        # decompilation, so only format them once
+        self._fmt_insts = None
     def __repr__(self):
         return 'BBlock(at %s, %s insts)' % (self.loc, len(self.insts))
     def replaceinst(self, ij, replaceinsts):
@@ -548,11 +691,54 @@ class BBlock(object):
         assert type(replaceinsts) is list
         newinsts[ij[0]:ij[1]] = replaceinsts
         return BBlock(newinsts, self.loc)
+    def replaceinsts(self, edits):
+        """
+        Make several edits with a single copy of the instructions. Each edit
+        is (i, j, replaceinsts) to replace self.insts[i:j], the edits must be
+        in order and not overlap.
+        """
+        newinsts = []
+        prevj = 0
+        for i, j, replaceinsts in edits:
+            assert prevj <= i <= j
+            assert type(replaceinsts) is list
+            newinsts.extend(self.insts[prevj:i])
+            newinsts.extend(replaceinsts)
+            prevj = j
+        newinsts.extend(self.insts[prevj:])
+        return BBlock(newinsts, self.loc)
     def appendinsts(self, insts):
         return self.replaceinst((len(self.insts), len(self.insts)), insts)
     def popinst(self):
         return self.replaceinst(len(self.insts)-1, [])
+    def num_unreduced(self):
+        """
+        Return the number of Tcl bytecode instructions (i.e. Inst objects)
+        remaining in this bblock.
+        """
+        if self._num_unreduced is None:
+            self._num_unreduced = len([
+                inst for inst in self.insts if inst.kind == KIND_INST
+            ])
+        return self._num_unreduced
+    def targets(self):
+        """
+        Return a tuple of the locs jumped to from this bblock.
+        """
+        if self._targets is None:
+            targets = [
+                inst.targetloc for inst in self.insts
+                if inst.kind == KIND_INST and inst.targetloc is not None
+            ]
+            if self.jump is not None and self.jump.targetloc is not None:
+                targets.append(self.jump.targetloc)
+            self._targets = tuple(targets)
+        return self._targets
     def fmt_insts(self):
+        if self._fmt_insts is None:
+            self._fmt_insts = self._build_fmt_insts()
+        return list(self._fmt_insts)
+    def _build_fmt_insts(self):
         fmt_list = []
         for inst in self.insts:
             if isinstance(inst, Inst):
@@ -571,7 +757,14 @@ class BBlock(object):
             fmt_list.append(fmt_str)
         return fmt_list
     def fmt(self):
-        return u'\n'.join(self.fmt_insts())
+        if self._fmt_insts is None:
+            self._fmt_insts = self._build_fmt_insts()
+        return u'\n'.join(self._fmt_insts)
+    def fmt_indented(self):
+        """
+        Like fmt, but with every line after the first indented by a tab.
+        """
+        return self.fmt().replace(u'\n', u'\n\t')
 
 ########################
 # Functions start here #
@@ -581,54 +774,56 @@ def getinsts(bc):
     """
     Given bytecode in a bytearray, return a list of Inst objects.
     """
-    bc = bc.copy()
+    bytecode = bc.bytecode()
+    numbytes = len(bytecode)
     insts = []
-    while len(bc) > 0:
-        insts.append(Inst(bc))
+    pc = bc.pc()
+    while pc < numbytes:
+        insts.append(Inst(bc, pc))
+        pc += INST_NUM_BYTES[bytecode[pc]]
     return insts
 
 def _bblock_create(insts):
     """
     Given a list of Inst objects, split them up into basic blocks.
     """
-    # Identify the beginnings and ends of all basic blocks
-    starts = set()
-    ends = set()
-    newstart = True
+    # Index of the instruction at each loc, -1 for locs inside an instruction
+    loc_to_idx = array('i', [-1]) * (insts[-1].loc + 1)
+    for i, inst in enumerate(insts):
+        loc_to_idx[inst.loc] = i
+    # Flag the instructions at the beginnings and ends of all basic blocks
+    starts = bytearray(len(insts))
+    ends = bytearray(len(insts))
+    starts[0] = 1
     for i, inst in enumerate(insts):
-        if newstart:
-            starts.add(inst.loc)
-            newstart = False
         if inst.targetloc is not None:
-            ends.add(inst.loc)
-            starts.add(inst.targetloc)
-            newstart = True
+            targetidx = loc_to_idx[inst.targetloc]
+            assert targetidx >= 0
+            ends[i] = 1
+            starts[targetidx] = 1
+            if i+1 < len(insts):
+                starts[i+1] = 1
             # inst before target inst is end of a bblock
-            # search through instructions for instruction before the target
-            if inst.targetloc != 0:
-                instbeforeidx = 0
-                while True:
-                    if insts[instbeforeidx+1].loc == inst.targetloc: break
-                    instbeforeidx += 1
-                instbefore = insts[instbeforeidx]
-                ends.add(instbefore.loc)
-        elif inst.name in ['beginCatch4', 'endCatch']:
-            starts.add(inst.loc)
-            if inst.loc != 0:
-                ends.add(insts[i-1].loc)
-    ends.add(insts[-1].loc)
-    # Create the basic blocks
-    assert len(starts) == len(ends)
+            if targetidx != 0:
+                ends[targetidx-1] = 1
+        elif IS_CATCH_OPCODE[inst.opcode]:
+            starts[i] = 1
+            if i != 0:
+                ends[i-1] = 1
+    ends[-1] = 1
+    # Create the basic blocks, every start must be paired with an end
     bblocks = []
-    bblocks_insts = insts[:]
-    for start, end in zip(sorted(list(starts)), sorted(list(ends))):
-        bbinsts = []
-        assert bblocks_insts[0].loc == start
-        while bblocks_insts[0].loc < end:
-            bbinsts.append(bblocks_insts.pop(0))
-        assert bblocks_insts[0].loc == end
-        bbinsts.append(bblocks_insts.pop(0))
-        bblocks.append(BBlock(bbinsts, bbinsts[0].loc))
+    startidx = None
+    for i in range(len(insts)):
+        if starts[i]:
+            assert startidx is None
+            startidx = i
+        assert startidx is not None
+        if ends[i]:
+            bbinsts = insts[startidx:i+1]
+            bblocks.append(BBlock(bbinsts, bbinsts[0].loc))
+            startidx = None
+    assert startidx is None
     return bblocks
 
 def _inst_reductions():
@@ -640,29 +835,26 @@ def _inst_reductions():
     firstop = lambda inst: inst.ops[0]
     def lit(s): return BCLiteral(None, s)
     def is_simple(arg):
-        return any([
-            isinstance(arg, bctype)
-            for bctype in [BCLiteral, BCVarRef, BCArrayRef]
-        ])
+        return arg.kind & KIND_SIMPLE
 
     def getargsgen(nargs_fn, checkargs_fn=None):
-        def getargsfn(inst, bblock, i):
+        def getargsfn(inst, insts):
             nargs = nargs_fn(inst)
             arglist = []
-            argis = []
-            for argi, arg in reversed(list(enumerate(bblock.insts[:i]))):
-                if len(arglist) == nargs:
-                    break
-                if not isinstance(arg, BCValue):
+            # Walk back down the stack from the top
+            argi = len(insts)
+            while len(arglist) < nargs and argi > 0:
+                argi -= 1
+                arg = insts[argi]
+                if not arg.kind & KIND_VALUE:
                     break
                 if arg.stackn < 1:
                     continue
                 if checkargs_fn and not checkargs_fn(arg):
                     break
                 arglist.append(arg)
-                argis.append(argi)
-            arglist.reverse()
             if len(arglist) != nargs: return None
+            arglist.reverse()
             return arglist
         return getargsfn
 
@@ -686,12 +878,14 @@ def _inst_reductions():
         'loadScalarStk': [[N(1)], BCVarRef],
         'loadArrayStk': [[N(2)], BCArrayRef],
         'loadScalar1': [[N(0)], lambda inst, kv: BCVarRef(inst, [lit(inst.ops[0])])],
+        'loadScalar4': [[N(0)], lambda inst, kv: BCVarRef(inst, [lit(inst.ops[0])])],
         'loadArray1': [[N(1)], lambda inst, kv: BCArrayRef(inst, [lit(inst.ops[0]), kv[0]])],
         # Variable sets
         'storeStk': [[N(2)], BCSet],
         'storeScalarStk': [[N(2)], BCSet],
         'storeArrayStk': [[N(3)], lambda inst, kv: BCSet(inst, [BCArrayElt(None, kv[:2]), kv[2]])],
         'storeScalar1': [[N(1)], lambda inst, kv: BCSet(inst, [lit(inst.ops[0]), kv[0]])],
+        'storeScalar4': [[N(1)], lambda inst, kv: BCSet(inst, [lit(inst.ops[0]), kv[0]])],
         'storeArray1': [[N(2)], lambda inst, kv: BCSet(inst, [BCArrayElt(None, [lit(inst.ops[0]), kv[0]]), kv[1]])],
         # Expressions
         'gt': [[N(2)], BCExpr],
@@ -721,6 +915,20 @@ def _inst_reductions():
     return inst_reductions
 
 INST_REDUCTIONS = _inst_reductions()
+def _inst_reductions_by_opcode():
+    """
+    Return a list indexed by opcode of (getargsfn, redfn), or None for
+    instructions with no reduction.
+    """
+    inst_reductions = []
+    for inst_type in INSTRUCTIONS:
+        IRED = INST_REDUCTIONS.get(inst_type['name'])
+        if IRED is not None:
+            IRED = (IRED['getargsfn'], IRED['redfn'])
+        inst_reductions.append(IRED)
+    return inst_reductions
+
+INST_REDUCTIONS_BY_OPCODE = _inst_reductions_by_opcode()
 
 def _bblock_hack(bc, bblock):
     """
@@ -731,76 +939,108 @@ def _bblock_hack(bc, bblock):
     variableis = []
     changes = []
     for i, inst in enumerate(bblock.insts):
-        if not isinstance(inst, Inst): continue
+        if inst.kind != KIND_INST: continue
         if not inst.name == 'variable': continue
-        assert bblock.insts[i+1].name in ['push1', 'push4']
+        assert bblock.insts[i+1].name in PUSH_INSTRUCTIONS
         assert bc.literal(bblock.insts[i+1].ops[0]) == ''
         variableis.append(i)
-    for i in reversed(variableis):
-        bblock = bblock.replaceinst(i+1, [])
-        changes.append((TAG_H_VARIABLE, (i+1, i+2), (i+1, i+1)))
+    if variableis:
+        bblock = bblock.replaceinsts([(i+1, i+2, []) for i in variableis])
+    # Each removal shifts the instructions after it back by one
+    for k, i in enumerate(variableis):
+        changes.append((TAG_H_VARIABLE, (i+1, i+2), (i+1-k, i+1-k)))
     return bblock, changes
 
 def _bblock_reduce(bc, bblock):
     """
     For the given basic block, attempt to reduce all instructions to my higher
     level representations.
+    This is a single left to right pass - reduced instructions are pushed onto
+    a stack and each instruction takes its arguments from the top of it.
+    Instructions before an irreducible instruction can never change, so this
+    reaches the same result as repeatedly reducing the first reducible
+    instruction.
+    BBlocks are never modified, so once a bblock is found to have nothing to
+    reduce it is never reduced again. Only new bblocks are revisited.
     """
-    changes = []
+    if bblock.reduced:
+        return bblock, []
+    # The reduced instructions so far
+    insts = []
+    # A list of [lfrom1, lfrom2, n, tag] describing where each run of n
+    # instructions in insts came from in the original bblock, tag is None
+    # if it is unchanged.
+    groups = []
     for i, inst in enumerate(bblock.insts):
-        if not isinstance(inst, Inst): continue
-
-        if inst.name in ['push1', 'push4']:
-            bblock = bblock.replaceinst(i, [BCLiteral(inst, bc.literal(inst.ops[0]))])
-            changes.append((TAG_I_PUSH, (i, i+1), (i, i+1)))
-
-        elif inst.name in INST_REDUCTIONS:
-            IRED = INST_REDUCTIONS[inst.name]
-            getargsfn = IRED['getargsfn']
-            redfn = IRED['redfn']
-            arglist = getargsfn(inst, bblock, i)
-            if arglist is None: continue
-            newinsts = redfn(inst, arglist)
-            if type(newinsts) is not list:
-                newinsts = [newinsts]
-            irange = (i-len(arglist), i+1)
-            bblock = bblock.replaceinst(irange, newinsts)
-            changes.append((TAG_I_OTHER, irange, (irange[0], irange[0]+len(newinsts))))
+        lfrom1 = i
+        if inst.kind != KIND_INST:
+            newinsts, tag = [inst], None
+
+        elif IS_PUSH_OPCODE[inst.opcode]:
+            newinsts, tag = [bc.bcliteral(inst.ops[0])], TAG_I_PUSH
+
+        elif INST_REDUCTIONS_BY_OPCODE[inst.opcode] is not None:
+            getargsfn, redfn = INST_REDUCTIONS_BY_OPCODE[inst.opcode]
+            arglist = getargsfn(inst, insts)
+            if arglist is None:
+                newinsts, tag = [inst], None
+            else:
+                newinsts = redfn(inst, arglist)
+                if type(newinsts) is not list:
+                    newinsts = [newinsts]
+                tag = TAG_I_OTHER
+                # Merge the runs the arguments were taken from (including any
+                # instructions sharing those runs) into this change
+                nargs = len(arglist)
+                while nargs > 0:
+                    lfrom1, _, n, _ = groups.pop()
+                    nargs -= n
+                argsidx = len(insts) - len(arglist)
+                newinsts = insts[argsidx+nargs:argsidx] + newinsts
+                del insts[argsidx+nargs:]
 
         else:
-            continue # No change, continue scanning basic blcok
+            newinsts, tag = [inst], None
 
-        break
+        groups.append([lfrom1, i+1, len(newinsts), tag])
+        insts.extend(newinsts)
 
+    changes = []
+    lto1 = 0
+    for lfrom1, lfrom2, n, tag in groups:
+        if tag is not None:
+            changes.append((tag, (lfrom1, lfrom2), (lto1, lto1+n)))
+        lto1 += n
+    if changes:
+        bblock = BBlock(insts, bblock.loc)
+    else:
+        bblock.reduced = True
     return bblock, changes
 
 def _get_targets(bblocks):
-    targets = [target for target in [
-        (lambda jump: jump and jump.targetloc)(_get_jump(src_bblock))
-        for src_bblock in bblocks
-    ] if target is not None]
-    inst_targets = [bblock.insts for bblock in bblocks]
-    inst_targets = [i for i in itertools.chain(*inst_targets)]
-    inst_targets = [i for i in inst_targets if isinstance(i, Inst)]
-    inst_targets = [i.targetloc for i in inst_targets if i.targetloc is not None]
-    return targets + inst_targets
-def _get_jump(bblock):
-    if len(bblock.insts) == 0: return None
-    jump = bblock.insts[-1]
-    if not isinstance(jump, BCJump): return None
-    return jump
-def _is_catch_begin(bblock):
-    if len(bblock.insts) == 0: return False
-    catch = bblock.insts[0]
-    if not isinstance(catch, Inst): return False
-    return catch.name == 'beginCatch4'
-def _is_catch_end(bblock):
-    if len(bblock.insts) == 0: return False
-    catch = bblock.insts[0]
-    if not isinstance(catch, Inst): return False
-    return catch.name == 'endCatch'
-
-def _bblock_flow(bblocks):
+    """
+    Return a Counter of the number of jumps to each loc from the bblocks.
+    """
+    targets = Counter()
+    for bblock in bblocks:
+        targets.update(bblock.targets())
+    return targets
+def _update_targets(targets, oldbblocks, newbblocks):
+    """
+    Update a Counter from _get_targets when oldbblocks have been replaced by
+    newbblocks. Locs no longer jumped to are left with a count of 0.
+    """
+    for bblock in oldbblocks:
+        targets.subtract(bblock.targets())
+    for bblock in newbblocks:
+        targets.update(bblock.targets())
+
+def _bblock_flow(bblocks, targets):
+    """
+    Recognise control flow structures spanning several bblocks and replace the
+    first found in bblocks. targets is from _get_targets(bblocks) and is kept
+    up to date.
+    """
     # Recognise a basic if.
     # Observe that we don't try and recognise a basic if with no else branch -
     # it turns out that tcl implicitly inserts the else to provide all
@@ -812,33 +1052,28 @@ def _bblock_flow(bblocks):
     #             |---------------------|        <- unconditional jump to end
     # We only care about the end block for checking that everything does end up
     # there. The other three blocks end up 'consumed' by a BCIf object.
-    for i in range(len(bblocks)):
-        if len(bblocks[i:i+4]) < 4:
-            continue
-        jump0 = _get_jump(bblocks[i+0])
-        jump1 = _get_jump(bblocks[i+1])
-        jump2 = _get_jump(bblocks[i+2])
+    for i in range(len(bblocks)-3):
+        bblock0, bblock1, bblock2, bblock3 = bblocks[i:i+4]
+        jump0 = bblock0.jump
+        jump1 = bblock1.jump
+        jump2 = bblock2.jump
         if jump0 is None or jump0.on is None: continue
         if jump1 is None or jump1.on is not None: continue
         if jump2 is not None: continue
-        if jump0.targetloc != bblocks[i+2].loc: continue
-        if jump1.targetloc != bblocks[i+3].loc: continue
-        if any([
-                isinstance(inst, Inst) for inst in
-                bblocks[i+1].insts + bblocks[i+2].insts
-                ]):
-            continue
-        targets = _get_targets(bblocks)
-        if targets.count(bblocks[i+1].loc) > 0: continue
-        if targets.count(bblocks[i+2].loc) > 1: continue
+        if jump0.targetloc != bblock2.loc: continue
+        if jump1.targetloc != bblock3.loc: continue
+        if bblock1.num_unreduced() or bblock2.num_unreduced(): continue
+        if targets[bblock1.loc] > 0: continue
+        if targets[bblock2.loc] > 1: continue
         # Looks like an 'if', apply the bblock transformation
-        changestart = ((i, 0), (i+2, len(bblocks[i+2].insts)))
-        jumps = [bblocks[i+0].insts[-1], bblocks[i+1].insts[-1]]
-        bblocks[i+0] = bblocks[i+0].popinst()
-        bblocks[i+1] = bblocks[i+1].popinst()
-        assert jumps == [jump0, jump1]
-        bblocks[i] = bblocks[i].appendinsts([BCIf(jumps, bblocks[i+1:i+3])])
+        changestart = ((i, 0), (i+2, len(bblock2.insts)))
+        jumps = [jump0, jump1]
+        bblock0 = bblock0.popinst()
+        bblock1 = bblock1.popinst()
+        oldbblocks = bblocks[i:i+3]
+        bblocks[i] = bblock0.appendinsts([BCIf(jumps, [bblock1, bblock2])])
         bblocks[i+1:i+3] = []
+        _update_targets(targets, oldbblocks, bblocks[i:i+1])
         changeend = ((i, 0), (i, len(bblocks[i].insts)))
         return [(TAG_IF, changestart, changeend)]
 
@@ -853,39 +1088,33 @@ def _bblock_flow(bblocks):
     # with a single BCCatch.
     # TODO: because we steal instructions from the endCatch block, the bblock 'loc'
     # is no longer correct!
-    for i in range(len(bblocks)):
-        if len(bblocks[i:i+3]) < 3:
-            continue
-        begin = bblocks[i+0]
-        middle = bblocks[i+1]
-        end = bblocks[i+2]
-        if not _is_catch_begin(begin): continue
-        if not _is_catch_end(end): continue
-        assert not (_is_catch_end(begin) or _is_catch_begin(end))
-        assert not (_is_catch_end(middle) or _is_catch_begin(middle))
-        if any([isinstance(inst, Inst) for inst in begin.insts[1:]]):
+    for i in range(len(bblocks)-2):
+        # Cheapest and most selective check first
+        if bblocks[i].catch != 'beginCatch4': continue
+        begin, middle, end = bblocks[i:i+3]
+        if end.catch != 'endCatch': continue
+        assert middle.catch is None
+        # Everything except the beginCatch4 must be reduced
+        if begin.num_unreduced() > 1:
             continue
         # Looks like a 'catch', apply the bblock transformation
         changestart = ((i, 0), (i+2, 4))
         endcatchinst = end.insts[0]
-        end = end.replaceinst(0, [])
-        endcatch = BBlock([endcatchinst], endcatchinst.loc)
-        if (len(end.insts) > 2 and
-                isinstance(end.insts[0], Inst) and
-                isinstance(end.insts[1], Inst) and
-                isinstance(end.insts[2], Inst) and
-                end.insts[0].name == 'reverse' and
-                end.insts[1].name == 'storeScalar1' and
-                end.insts[2].name == 'pop'
-            ):
-            endcatch = endcatch.appendinsts(list(end.insts[0:3]))
-            end = end.replaceinst((0, 3), [])
+        endinsts = end.insts[1:4]
+        endnames = tuple([
+            inst.kind == KIND_INST and inst.name for inst in endinsts
+        ])
+        if endnames == ('reverse', 'storeScalar1', 'pop'):
+            endcatch = BBlock([endcatchinst] + list(endinsts), endcatchinst.loc)
+            end = end.replaceinst((0, 4), [])
         else:
             assert False
         bccatch = BCCatch(None, [begin, middle, endcatch])
-        bblocks[i] = begin.replaceinst((0, len(begin.insts)), [bccatch])
+        oldbblocks = bblocks[i:i+3]
+        bblocks[i] = BBlock([bccatch], begin.loc)
         bblocks[i+2] = end
         bblocks[i+1:i+2] = []
+        _update_targets(targets, oldbblocks, bblocks[i:i+2])
         changeend = ((i, 0), (i, len(bblocks[i].insts)))
         return [(TAG_CATCH, changestart, changeend)]
 
@@ -898,33 +1127,31 @@ def _bblock_flow(bblocks):
     # there. The other three blocks end up 'consumed' by a BCForEach object.
     # If possible, we try and consume the BCLiteral sitting in the first instruction of
     # end, though it may already have been consumed by a return call.
-    for i in range(len(bblocks)):
-        if len(bblocks[i:i+4]) < 4:
-            continue
-        jump0 = _get_jump(bblocks[i+0])
+    for i in range(len(bblocks)-3):
+        # Cheapest and most selective check first.
+        # Unreduced because jumps don't know how to consume foreach_step
         jump1 = bblocks[i+1].insts[-1]
-        jump2 = _get_jump(bblocks[i+2])
+        if jump1.kind != KIND_INST or jump1.name != 'jumpFalse1': continue
+        jump0 = bblocks[i+0].jump
+        jump2 = bblocks[i+2].jump
         if jump0 is not None: continue
-        # Unreduced because jumps don't know how to consume foreach_step
-        if not isinstance(jump1, Inst) or jump1.name != 'jumpFalse1': continue
         if jump2 is None or jump2.on is not None: continue
-        if jump1.targetloc is not bblocks[i+3].loc: continue
-        if jump2.targetloc is not bblocks[i+1].loc: continue
-        if any([isinstance(inst, Inst) for inst in bblocks[i+2].insts]): continue
+        if jump1.targetloc != bblocks[i+3].loc: continue
+        if jump2.targetloc != bblocks[i+1].loc: continue
+        if bblocks[i+2].num_unreduced(): continue
         if not isinstance(bblocks[i+3].insts[0], BCLiteral): continue
-        targets = _get_targets(bblocks)
-        if targets.count(bblocks[i+1].loc) > 1: continue
-        if targets.count(bblocks[i+2].loc) > 0: continue
-        if targets.count(bblocks[i+3].loc) > 1: continue
+        if targets[bblocks[i+1].loc] > 1: continue
+        if targets[bblocks[i+2].loc] > 0: continue
+        if targets[bblocks[i+3].loc] > 1: continue
         # Looks like a 'foreach', apply the bblock transformation
         changestart = ((i, len(bblocks[i].insts)-1), (i+3, 1))
-        foreach_start = bblocks[i].insts[-1]
-        bblocks[i] = bblocks[i].popinst()
-        numvarlists = len(foreach_start.ops[0][1])
-        varlists = []
-        for i in range(numvarlists):
-            varlists.append(bblocks[i].insts[-1])
-            bblocks[i] = bblocks[i].popinst()
+        oldbblocks = bblocks[i:i+4]
+        # Each varlist's list is set to a temp var just before foreach_start
+        insts = bblocks[i].insts
+        foreach_start = insts[-1]
+        varlistsidx = len(insts) - 1 - len(foreach_start.ops[0][1])
+        varlists = list(insts[varlistsidx:-1])
+        bblocks[i] = bblocks[i].replaceinst((varlistsidx, len(insts)), [])
         # TODO: Location isn't actually correct...do we care?
         begin = BBlock(varlists + [foreach_start], foreach_start.loc)
         end = bblocks[i+3].insts[0]
@@ -932,20 +1159,25 @@ def _bblock_flow(bblocks):
         foreach = BCForeach(None, [begin] + bblocks[i+1:i+3] + [end])
         bblocks[i] = bblocks[i].appendinsts([foreach])
         bblocks[i+1:i+3] = []
+        _update_targets(targets, oldbblocks, bblocks[i:i+2])
         changeend = ((i, len(bblocks[i].insts)-1), (i, len(bblocks[i].insts)))
         return [(TAG_FOREACH, changestart, changeend)]
 
     return []
 
-def _bblock_join(bblocks):
+def _bblock_join(bblocks, targets):
+    """
+    Remove or join together the first bblocks possible. targets is from
+    _get_targets(bblocks) and is kept up to date.
+    """
 
     # Remove empty unused blocks
     # TODO: unknown if this is needed
     for i, bblock in enumerate(bblocks):
         if len(bblock.insts) > 0: continue
-        targets = _get_targets(bblocks)
-        if bblock.loc in targets: continue
+        if targets[bblock.loc] > 0: continue
         bblocks[i:i+1] = []
+        _update_targets(targets, [bblock], [])
 
         previ = 0 if i == 0 else i-1
         previlen = len(bblocks[previ].insts)
@@ -956,24 +1188,22 @@ def _bblock_join(bblocks):
         if len(bblocks[i:i+2]) < 2:
             continue
         bblock1, bblock2 = bblocks[i:i+2]
-        targets = _get_targets(bblocks)
         # If the end of bblock1 or the beginning of bblock2 should remain as
         # bblock boundaries, do not join them.
-        if _get_jump(bblock1) is not None:
+        if bblock1.jump is not None:
             continue
         # Unreduced jumps
-        if any([isinstance(inst, Inst) and inst.targetloc is not None
-                for inst in bblock1.insts[-1:]]):
+        if any(inst.kind == KIND_INST and inst.targetloc is not None
+                for inst in bblock1.insts[-1:]):
             continue
-        if bblock2.loc in targets:
+        if targets[bblock2.loc] > 0:
             continue
-        if _is_catch_begin(bblock2):
-            continue
-        if _is_catch_end(bblock2):
+        if bblock2.catch is not None:
             continue
         changestart = ((i, 0), (i+1, len(bblocks[i+1].insts)))
         bblocks[i] = bblock1.appendinsts(list(bblock2.insts))
         bblocks[i+1:i+2] = []
+        _update_targets(targets, [bblock1, bblock2], bblocks[i:i+1])
         changeend = ((i, 0), (i, len(bblocks[i].insts)))
         return [(TAG_BLOCK_JOIN, changestart, changeend)]
 
@@ -986,9 +1216,11 @@ def _bblocks_operation(bblock_op, bc, bblocks):
     """
     operbblocks = []
     operchanges = []
-    operlist = [bblock_op(bc, bblock) for bblock in bblocks]
-    for bbi, (operbblock, bblockchanges) in enumerate(operlist):
+    for bbi, bblock in enumerate(bblocks):
+        operbblock, bblockchanges = bblock_op(bc, bblock)
         operbblocks.append(operbblock)
+        if not bblockchanges:
+            continue
         operchanges.extend([
             (tag, ((bbi, lfrom1), (bbi, lfrom2)), ((bbi, lto1), (bbi, lto2)))
             for tag, (lfrom1, lfrom2), (lto1, lto2) in bblockchanges
@@ -1010,30 +1242,95 @@ def _decompile(bc):
         bblocks = hackedbblocks
         yield bblocks[:], changes
 
+    # Kept up to date as bblocks change rather than recounted for every check
+    targets = _get_targets(bblocks)
+    # The passes are tried in order of precedence: all reductions possible,
+    # then a single join, then a single flow structure. Every flow
+    # recogniser relies on the bblocks it looks at being fully reduced and
+    # joined, so they are not fused into one pass.
     changes = True
     while changes:
         changes = []
         if not changes:
-            bblocks, changes = _bblocks_operation(_bblock_reduce, bc, bblocks)
+            reducedbblocks, changes = _bblocks_operation(_bblock_reduce, bc, bblocks)
+            # Only bblocks named in the changes have been replaced
+            bbis = set([change[1][0][0] for change in changes])
+            _update_targets(
+                targets,
+                [bblocks[bbi] for bbi in bbis],
+                [reducedbblocks[bbi] for bbi in bbis]
+            )
+            bblocks = reducedbblocks
         if not changes:
-            changes = _bblock_join(bblocks)
+            changes = _bblock_join(bblocks, targets)
         if not changes:
-            changes = _bblock_flow(bblocks)
-        if changes: yield bblocks[:], changes
+            changes = _bblock_flow(bblocks, targets)
+        if changes:
+            yield bblocks[:], changes
 
 def _bblocks_fmt(bblocks):
-    outstr = ''
+    outstrs = []
     for bblock in bblocks:
-        #outstr += '===========%s\n' % (bblock)
-        outstr += bblock.fmt()
-        outstr += '\n'
-    return outstr
+        #outstrs.append('===========%s\n' % (bblock))
+        outstrs.append(bblock.fmt())
+        outstrs.append('\n')
+    return ''.join(outstrs)
+
+# Decompiled source keyed by BC.key(), least recently used first
+DECOMPILE_CACHE_SIZE = 1024
+_decompile_cache = OrderedDict()
 
 def decompile(bc):
-    bblocks = None
-    for bblocks, _ in _decompile(bc):
-        pass
-    return _bblocks_fmt(bblocks)
+    key = bc.key()
+    outstr = _decompile_cache.pop(key, None)
+    if outstr is None:
+        bblocks = None
+        for bblocks, _ in _decompile(bc):
+            pass
+        outstr = _bblocks_fmt(bblocks)
+    _decompile_cache_add(key, outstr)
+    return outstr
+
+def _decompile_cache_add(key, outstr):
+    _decompile_cache[key] = outstr
+    while len(_decompile_cache) > DECOMPILE_CACHE_SIZE:
+        _decompile_cache.popitem(last=False)
+
+def decompile_many(bcs, processes=None):
+    """
+    Decompile a list of BC objects, returning a list of strings. Anything not
+    already in the decompile cache is decompiled in a pool of `processes`
+    worker processes (default: one per cpu), once per distinct bytecode. If
+    `processes` is 1 they are decompiled in this process instead.
+    """
+    keys = [bc.key() for bc in bcs]
+    outstrs = {}
+    todo = OrderedDict()
+    for key, bc in zip(keys, bcs):
+        if key in outstrs or key in todo:
+            continue
+        outstr = _decompile_cache.pop(key, None)
+        if outstr is None:
+            todo[key] = bc
+        else:
+            # Refresh it as most recently used, as decompile does
+            outstrs[key] = outstr
+            _decompile_cache_add(key, outstr)
+    if not todo:
+        newoutstrs = []
+    elif processes == 1:
+        newoutstrs = [decompile(bc) for bc in todo.values()]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            newoutstrs = pool.map(decompile, list(todo.values()))
+        finally:
+            pool.close()
+            pool.join()
+    for key, outstr in zip(todo.keys(), newoutstrs):
+        outstrs[key] = outstr
+        _decompile_cache_add(key, outstr)
+    return [outstrs[key] for key in keys]
 
 def decompile_steps(bc):
     """
@@ -1068,20 +1365,29 @@ def decompile_steps(bc):
     Note that these are *slice* indexes, i.e. like python. So if lto1 and lto2
     are the same, it means the source lines have been reduced to a line of
     width 0 (i.e. have been removed entirely).
+    A step may have several changes (e.g. every instruction reduction made in
+    one pass over the bblocks), these are in order and do not overlap.
     """
     steps = []
     changes = []
-    for si, (sbblocks, schanges) in enumerate(_decompile(bc)):
-        step = []
-        for sbblock in sbblocks:
-            step.append(sbblock.fmt_insts())
-        for schange in schanges:
-            tag, lfrom, lto = schange
-            changes.append({
-                'step': si-1,
-                'from': lfrom,
-                'to': lto,
-                'tag': tag,
-            })
+    for step, stepchanges in iter_decompile_steps(bc):
         steps.append(step)
+        changes.extend(stepchanges)
     return steps, changes
+
+def iter_decompile_steps(bc):
+    """
+    Given some bytecode, lazily yields a tuple of `(step, changes)` for each
+    step of decompilation, where `changes` are the change descriptors leading
+    to that step. See `decompile_steps` for the formats.
+    Decompilation only progresses as far as the steps consumed.
+    """
+    for si, (sbblocks, schanges) in enumerate(_decompile(bc)):
+        step = [sbblock.fmt_insts() for sbblock in sbblocks]
+        changes = [{
+            'step': si-1,
+            'from': lfrom,
+            'to': lto,
+            'tag': tag,
+        } for tag, lfrom, lto in schanges]
+        yield step, changes
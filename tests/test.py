@@ -9,6 +9,7 @@ cases = []
 cases.append(('set', u'set x 15\n'))
 cases.append(('set_array', u'set x(a) 15\n'))
 cases.append(('array_set', u'array set x {a 1 b 2}\n')) # **
+cases.append(('literal_escape', u'puts "a\\"b\\r"\n'))
 cases.append(('ref', u'puts $a\nputs $u::a\n'))
 cases.append(('ref_array', u'puts $x(a)\n'))
 cases.append(('incr', u'incr x\nincr x 5\n')) # **
@@ -90,6 +91,15 @@ foreach {a b} {1 2 3 4} {
 puts x
 ''')) # **
 
+# Enough locals and code that bytecode locations can't be cached small ints
+cases.append(('foreach_far', u''.join([
+    u'set x%s %s\n' % (i, i) for i in range(300)
+]) + u'''\
+foreach {a b} {1 2 3 4} {
+\tputs $a
+}
+''')) # **
+
 # TODO: dict for **
 # TODO: expr **
 
@@ -104,6 +114,17 @@ if {$a} {
 }
 ''')) # **
 
+# Only tested in a proc, at the top level foreach is left as a proc call
+proc_cases = []
+# The foreach start isn't in the first bblock
+proc_cases.append(('if_foreach', u'''\
+if {$a} {
+\tforeach {b c} {1 2} {
+\t\tputs $b
+\t}
+}
+'''))
+
 # ----------
 
 def checkDecompileStepStructure(self, steps, changes):
@@ -144,6 +165,29 @@ def checkDecompileStepStructure(self, steps, changes):
             self.assertIs(type(locinfo[0]), int)
             self.assertIs(type(locinfo[1]), int)
 
+    # Check that replacing the 'from' lines of each change (there may be
+    # several per step) with its 'to' lines turns each step into the next
+    def flatidx(snapshot, loc):
+        bbi, li = loc
+        return sum([len(bblock) for bblock in snapshot[:bbi]]) + li
+    for si in range(len(steps)-1):
+        prevlines = sum(steps[si], [])
+        lines = sum(steps[si+1], [])
+        stepchanges = [change for change in changes if change['step'] == si]
+        self.assertGreater(len(stepchanges), 0)
+        applied = []
+        prevfrom2 = prevto2 = 0
+        for change in stepchanges:
+            from1, from2 = [flatidx(steps[si], l) for l in change['from']]
+            to1, to2 = [flatidx(steps[si+1], l) for l in change['to']]
+            self.assertTrue(prevfrom2 <= from1 <= from2 <= len(prevlines))
+            self.assertTrue(prevto2 <= to1 <= to2 <= len(lines))
+            applied.extend(prevlines[prevfrom2:from1])
+            applied.extend(lines[to1:to2])
+            prevfrom2, prevto2 = from2, to2
+        applied.extend(prevlines[prevfrom2:])
+        self.assertEqual(applied, lines)
+
     # Check we have no 0 length bblocks in final result
     self.assertGreater(len(steps), 0)
     self.assertGreater(len(steps[-1]), 0) # snapshot
@@ -170,6 +214,74 @@ class TestTclProc(unittest.TestCase):
         steps, changes = tcldis.decompile_steps(tcldis.getbc(proc_name='p'))
         checkDecompileStepStructure(self, steps, changes)
 
+class TestDecompileCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_size = tcldis.DECOMPILE_CACHE_SIZE
+    def tearDown(self):
+        tcldis.DECOMPILE_CACHE_SIZE = self.cache_size
+    def test_cache(self):
+        tcl = u'set x 15\n'
+        outstr = tcldis.decompile(tcldis.getbc(tcl))
+        self.assertEqual(tcl, outstr)
+        # Equal bytecode gets the cached result
+        self.assertIs(outstr, tcldis.decompile(tcldis.getbc(tcl)))
+        self.assertEqual(u'set y 15\n', tcldis.decompile(tcldis.getbc(u'set y 15\n')))
+    def test_cache_evict(self):
+        tcldis.DECOMPILE_CACHE_SIZE = 2
+        tcls = [u'set x 17\n', u'set y 17\n', u'set z 17\n']
+        outstrs = [tcldis.decompile(tcldis.getbc(tcl)) for tcl in tcls]
+        # The least recently used result is dropped
+        self.assertIs(outstrs[2], tcldis.decompile(tcldis.getbc(tcls[2])))
+        outstr = tcldis.decompile(tcldis.getbc(tcls[0]))
+        self.assertEqual(tcls[0], outstr)
+        self.assertIsNot(outstrs[0], outstr)
+    def test_many(self):
+        tcls = [u'set x 16\n', u'set y 16\n', u'set x 16\n']
+        bcs = [tcldis.getbc(tcl) for tcl in tcls]
+        outstrs = tcldis.decompile_many(bcs, processes=1)
+        self.assertEqual(tcls, outstrs)
+        self.assertIs(outstrs[1], tcldis.decompile(bcs[1]))
+    def test_many_pool(self):
+        # Nothing cached, so everything goes through the worker processes
+        tcldis.DECOMPILE_CACHE_SIZE = 0
+        bcs = [tcldis.getbc(case) for _, case in cases]
+        outstrs = tcldis.decompile_many(bcs, processes=2)
+        self.assertEqual([tcldis.decompile(bc) for bc in bcs], outstrs)
+    def test_many_cache_evict(self):
+        tcldis.DECOMPILE_CACHE_SIZE = 2
+        tcls = [u'set x 18\n', u'set y 18\n', u'set z 18\n']
+        outstrs = [tcldis.decompile(tcldis.getbc(tcl)) for tcl in tcls[:2]]
+        # Using a cached result makes it the most recently used
+        tcldis.decompile_many([tcldis.getbc(tcls[0])], processes=1)
+        tcldis.decompile(tcldis.getbc(tcls[2]))
+        self.assertIs(outstrs[0], tcldis.decompile(tcldis.getbc(tcls[0])))
+
+class TestBytecode(unittest.TestCase):
+    def getbc(self, insts, literals, locals):
+        """
+        Assemble a BC from a list of (instruction name, operand), the operand
+        filling the rest of the instruction.
+        """
+        inst_types = dict([
+            (inst_type['name'], (opcode, inst_type['num_bytes']))
+            for opcode, inst_type in enumerate(tcldis.INSTRUCTIONS)
+        ])
+        bytecode = bytearray()
+        for name, op in insts:
+            opcode, num_bytes = inst_types[name]
+            bytecode.append(opcode)
+            for shift in reversed(range(num_bytes-1)):
+                bytecode.append((op >> (8*shift)) & 0xff)
+        return tcldis.BC(bytecode, literals, locals, [])
+    def test_variable_twice(self):
+        # As older Tcl compiles 'variable x; variable y', with no nops
+        bc = self.getbc([
+            ('push1', 0), ('variable', 0), ('push1', 1), ('pop', 0),
+            ('push1', 2), ('variable', 1), ('push1', 1), ('done', 0),
+        ], [u'x', u'', u'y'], [u'x', u'y'])
+        self.assertEqual(u'variable x\nvariable y\n', tcldis.decompile(bc))
+        steps, changes = tcldis.decompile_steps(bc)
+        checkDecompileStepStructure(self, steps, changes)
 
 def setupcase(test_class, name, case):
     setattr(
@@ -187,6 +299,8 @@ for name, case in cases:
     setupcase(TestTclScript, name, case)
     if name != 'array_set':
         setupcase(TestTclProc, name, case)
+for name, case in proc_cases:
+    setupcase(TestTclProc, name, case)
 
 if __name__ == '__main__':
     unittest.main()